@@ -24,6 +24,8 @@ CFG.DATASET.NAME = 'cifar10'
 CFG.DATASET.NUM_LABELED = 250
 CFG.DATASET.NUM_CLASSES = 10
 CFG.DATASET.NUM_WORKERS = 4
+CFG.DATASET.PIN_MEMORY = True
+CFG.DATASET.PREFETCH_FACTOR = 4
 CFG.DATASET.CONVERT_ONE_HOT = True
 CFG.DATASET.IMG_SIZE = 32
 CFG.DATASET.URATIO = 7
@@ -50,6 +52,7 @@ CFG.OPTIMIZER.SKIP_BN = True
 CFG.TRAINER = CN()
 CFG.TRAINER.SAT_EMA = 0.999
 CFG.TRAINER.AMP_ENABLED = False
+CFG.TRAINER.CHANNELS_LAST = True
 CFG.TRAINER.NUM_WARMUP_ITERS = 0
 CFG.TRAINER.NUM_TRAIN_ITERS = 1048576 # 2^20
 CFG.TRAINER.NUM_EVAL_ITERS = 5120
@@ -58,4 +61,9 @@ CFG.TRAINER.EMA_VAL = 0.999
 CFG.TRAINER.ULB_LOSS_RATIO = 1.0
 CFG.TRAINER.ENT_LOSS_RATIO = 0.1
 CFG.TRAINER.POLOSS = False
+CFG.TRAINER.SAM_SKIP_STRONG = False
+CFG.TRAINER.LABEL_BANK_DTYPE = 'float16'
+CFG.TRAINER.CUDA_GRAPH = False
+CFG.TRAINER.COMPILE = False
+CFG.TRAINER.ASYNC_EVAL = False
 CFG.TRAINER.GPU = 0
@@ -1,4 +1,5 @@
 from .datamaker import DataMaker
 from .dataset import MyDataset
 from .randaugment import RandAugment
-from .datamanager import FreeMatchDataManager
\ No newline at end of file
+from .datamanager import FreeMatchDataManager
+from .prefetcher import CUDAPrefetcher
\ No newline at end of file
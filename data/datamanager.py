@@ -48,9 +48,9 @@ class FreeMatchDataManager:
             convert_one_hot=cfg.CONVERT_ONE_HOT    
         )
         
-        self.train_lb_dl = self.__get_dataloader__(train_lb_data, cfg.TRAIN_BATCH_SIZE, cfg.NUM_WORKERS, num_iters=self.num_train_iters)
-        self.train_ulb_dl = self.__get_dataloader__(train_ulb_data, cfg.TRAIN_BATCH_SIZE * cfg.URATIO, cfg.NUM_WORKERS, num_iters=self.num_train_iters)
-        self.test_dl = self.__get_dataloader__(test_data, cfg.TEST_BATCH_SIZE, cfg.NUM_WORKERS, train=False)
+        self.train_lb_dl = self.__get_dataloader__(train_lb_data, cfg.TRAIN_BATCH_SIZE, cfg, num_iters=self.num_train_iters)
+        self.train_ulb_dl = self.__get_dataloader__(train_ulb_data, cfg.TRAIN_BATCH_SIZE * cfg.URATIO, cfg, num_iters=self.num_train_iters)
+        self.test_dl = self.__get_dataloader__(test_data, cfg.TEST_BATCH_SIZE, cfg, train=False)
 
     @staticmethod 
     def __get_data_dist__(data_lb):
@@ -78,21 +78,35 @@ class FreeMatchDataManager:
         print(tabulate(table, headers=headers))
             
     @staticmethod
-    def __get_dataloader__(data, batch_size, num_workers, num_iters=1, train=True):
+    def __get_dataloader__(data, batch_size, cfg, num_iters=1, train=True):
+        
+        # Pinned batches let the trainer copy them to the GPU with non_blocking=True.
+        # Workers are kept alive across epochs/evaluations and prefetch a few batches ahead.
+        loader_kwargs = {
+            'num_workers': cfg.NUM_WORKERS,
+            'pin_memory': cfg.PIN_MEMORY
+        }
+        if cfg.NUM_WORKERS > 0:
+            loader_kwargs.update(
+                {
+                    'persistent_workers': True,
+                    'prefetch_factor': cfg.PREFETCH_FACTOR
+                }
+            )
         
         if not train:
             return DataLoader(
                 data,
                 batch_size=batch_size,
-                num_workers=num_workers
+                **loader_kwargs
             )
         
         sampler = RandomSampler(data, replacement=True, num_samples=num_iters * batch_size, generator=None) 
         batch_sampler = BatchSampler(sampler, batch_size=batch_size, drop_last=True)
         return DataLoader(
             data,
-            num_workers=num_workers,
             batch_sampler=batch_sampler,
+            **loader_kwargs
         )
         
     @staticmethod
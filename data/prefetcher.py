@@ -0,0 +1,79 @@
+import torch
+
+class CUDAPrefetcher:
+    """Iterate over dataloaders while the next batch is copied to the GPU on a side stream.
+
+    Adapted from the data_prefetcher of the NVIDIA apex ImageNet example. The host to device
+    copy of batch i + 1 overlaps with the compute of batch i. Only the tensors in `keys` are
+    copied (all of them if None), 4D image tensors are converted to `memory_format`.
+    
+    Several loaders are advanced together like zip(), yielding one batch per loader. Their
+    copies share the side stream and a single wait per step, and `keys` is then a list with
+    the keys of each loader.
+    """
+    
+    def __init__(self, *loaders, keys=None, device='cuda', memory_format=torch.contiguous_format):
+        
+        self.loaders = loaders
+        self.keys = keys if len(loaders) > 1 else [keys]
+        if self.keys is None:
+            self.keys = [None] * len(loaders)
+        assert len(self.keys) == len(loaders)
+        
+        self.device = device
+        self.memory_format = memory_format
+        self.stream = torch.cuda.Stream()
+        self.loader_iters = None
+        self.next_batches = None
+    
+    def __len__(self):
+        
+        return min(len(loader) for loader in self.loaders)
+    
+    def __iter__(self):
+        
+        self.loader_iters = [iter(loader) for loader in self.loaders]
+        self.__preload__()
+        return self
+    
+    def __next__(self):
+        
+        torch.cuda.current_stream().wait_stream(self.stream)
+        batches = self.next_batches
+        if batches is None:
+            raise StopIteration
+        
+        # The tensors were allocated on the side stream but are consumed on the current one
+        for batch in batches:
+            for value in batch.values():
+                if torch.is_tensor(value) and value.is_cuda:
+                    value.record_stream(torch.cuda.current_stream())
+        
+        self.__preload__()
+        return batches[0] if len(batches) == 1 else batches
+    
+    def __preload__(self):
+        
+        # The loaders have their own worker pools, which already prepare their batches in parallel
+        try:
+            batches = [next(loader_iter) for loader_iter in self.loader_iters]
+        except StopIteration:
+            self.next_batches = None
+            return
+        
+        with torch.cuda.stream(self.stream):
+            self.next_batches = tuple(
+                {
+                    key: self.__to__device__(value) if keys is None or key in keys else value
+                    for key, value in batch.items()
+                }
+                for batch, keys in zip(batches, self.keys)
+            )
+    
+    def __to__device__(self, value):
+        
+        if not torch.is_tensor(value):
+            return value
+        if value.dim() == 4:
+            return value.to(self.device, non_blocking=True, memory_format=self.memory_format)
+        return value.to(self.device, non_blocking=True)
@@ -3,9 +3,12 @@ import torch.nn.functional as F
 import numpy as np
 import os.path as osp
 import os
+import copy
+import threading
 from contextlib import nullcontext
+from functools import partial
 from torch.cuda.amp import autocast, GradScaler
-from data import FreeMatchDataManager
+from data import FreeMatchDataManager, CUDAPrefetcher
 from networks import avail_models
 import pprint
 import torch.nn as nn
@@ -20,15 +23,8 @@ from utils import (
     CELoss,
     enable_running_stats,
     disable_running_stats,
-)
-
-from sklearn.metrics import (
-    classification_report, 
-    confusion_matrix, 
-    accuracy_score, 
-    precision_score, 
-    recall_score,
-    f1_score
+    get_bn_modules,
+    make_graphed_model,
 )
 
 class FreeMatchTrainer:
@@ -65,7 +61,10 @@ class FreeMatchTrainer:
             pretrained_path=cfg.MODEL.PRETRAINED_PATH
         )
         print('Number of Trainable Params: ', sum(p.numel() for p in self.model.parameters() if p.requires_grad))
-        self.model = self.model.to(self.device)
+        # NHWC lets cuDNN pick the tensor core convolution kernels without transposes.
+        # The EMA copies below inherit the memory format of the model params.
+        self.memory_format = torch.channels_last if cfg.TRAINER.CHANNELS_LAST else torch.contiguous_format
+        self.model = self.model.to(self.device, memory_format=self.memory_format)
         self.model.train()
         
         self.net = EMA(
@@ -75,6 +74,16 @@ class FreeMatchTrainer:
 
         self.net.train()
         
+        # Trainable params for the SAM steps, gathered once instead of walking the modules every step.
+        # sam_params is the subset reached by the labeled loss, filled on the first SAM step.
+        self.model_params = [p for p in self.net.model.parameters() if p.requires_grad]
+        self.sam_params = None
+        self.bn_modules = get_bn_modules(self.net.model)
+        
+        # Before torch 2.1, _foreach_mul has no Tensor overload and would call .item() on the
+        # 0-dim SAM scale, syncing the host every step.
+        self.foreach_tensor_scalar = tuple(int(v) for v in torch.__version__.split('.')[:2]) >= (2, 1)
+        
         # Use Tensorboard if logging is enabled
         if cfg.USE_TB:
             self.tb = TensorBoardLogger(
@@ -98,18 +107,54 @@ class FreeMatchTrainer:
         self.ce_criterion = CELoss()
         self.saf_criterion = SelfAdaptiveFairnessLoss()
         
+        # The loss pipeline is a chain of small elementwise kernels, let Inductor fuse it.
+        # The network itself is left eager (or in CUDA graphs, see TRAINER.CUDA_GRAPH).
+        self.compute_losses = self.__compute__losses__
+        if cfg.TRAINER.COMPILE:
+            if hasattr(torch, 'compile'):
+                self.compute_losses = torch.compile(self.__compute__losses__, mode='reduce-overhead', dynamic=False)
+            else:
+                print('torch.compile is not available in this torch version, computing the losses eagerly.')
+        
         # Initialize the class params
         self.curr_iter = 0
         self.best_test_iter = -1
         self.best_test_acc = -1
-        self.p_t = torch.ones(cfg.DATASET.NUM_CLASSES) / cfg.DATASET.NUM_CLASSES
-        self.label_hist = torch.ones(cfg.DATASET.NUM_CLASSES) / cfg.DATASET.NUM_CLASSES
-        self.tau_t = self.p_t.mean()
+        
+        # SAT/SAF statistics, kept as device buffers which are only ever updated in place
+        self.state = nn.Module()
+        self.state.register_buffer('p_t', torch.ones(cfg.DATASET.NUM_CLASSES) / cfg.DATASET.NUM_CLASSES)
+        self.state.register_buffer('label_hist', torch.ones(cfg.DATASET.NUM_CLASSES) / cfg.DATASET.NUM_CLASSES)
+        self.state.register_buffer('tau_t', self.state.p_t.mean())
+        self.state.to(self.device)
+
+        # Banks of the last weak/strong pseudo labels of every unlabeled sample for the PO loss.
+        # They hold probabilities in [0, 1], so 16 bit floats are enough and halve the memory and traffic.
+        self.label_bank_w, self.label_bank_s = None, None
+        if self.x_sharp:
+            num_samples = len(self.dm.train_ulb_dl.dataset)
+            assert cfg.TRAINER.LABEL_BANK_DTYPE in ['float16', 'bfloat16', 'float32']
+            bank_dtype = getattr(torch, cfg.TRAINER.LABEL_BANK_DTYPE)
+            self.label_bank_w = torch.full((num_samples, self.num_classes), 1. / self.num_classes, dtype=bank_dtype, device=self.device)
+            self.label_bank_s = torch.full((num_samples, self.num_classes), 1. / self.num_classes, dtype=bank_dtype, device=self.device)
+
+        # CUDA graphs replay the captured kernels with fixed shapes, which the SAM
+        # branch cannot satisfy (two forwards and a torch.autograd.grad per step).
+        self.use_cuda_graph = cfg.TRAINER.CUDA_GRAPH and self.device == 'cuda'
+        if self.use_cuda_graph and self.x_sharp:
+            print('CUDA graphs are not supported with X_SHARP, running the model eagerly.')
+            self.use_cuda_graph = False
+        self.graphed_model = None
+        
+        # Validation of an EMA snapshot on a side stream, overlapping the next training iterations
+        self.async_eval = cfg.TRAINER.ASYNC_EVAL and self.device == 'cuda'
+        self.eval_model, self.val_stream, self.pending_eval = None, None, None
 
         self.amp = nullcontext
         if cfg.TRAINER.AMP_ENABLED:
             self.scaler = GradScaler()
-            self.amp = autocast
+            # Autocast must not cache casted weights across graph replays
+            self.amp = partial(autocast, cache_enabled=False) if self.use_cuda_graph else autocast
 
         # Load Model if resume is true
         if cfg.CONT_TRAIN:
@@ -122,12 +167,90 @@ class FreeMatchTrainer:
             print('Evaluating after warmup')
             validate_dict = self.validate()
             pprint.pprint(validate_dict, indent=4)
-        
-        self.__toggle__device__()
 
     def norm(self, tensor_list, p=2):
-        """Compute p-norm for tensor list"""
-        return torch.cat([x.flatten() for x in tensor_list if x is not None]).norm(p)
+        """Compute p-norm for tensor list as the norm of the per-tensor norms"""
+        tensor_list = [x for x in tensor_list if x is not None]
+        if hasattr(torch, '_foreach_norm'):
+            norms = torch._foreach_norm(tensor_list, p)
+        else:
+            norms = [x.norm(p) for x in tensor_list]
+        return torch.linalg.vector_norm(torch.stack(norms), p)
+
+    @torch.no_grad()
+    def __restore__sam__params__(self):
+        """Remove the SAM perturbation and add the labeled loss gradient of the unperturbed weights"""
+        torch._foreach_sub_(self.sam_params, self.eps)
+        
+        # Gradients are reset with set_to_none, params left without one just take the SAM gradient
+        has_grad = [p.grad is not None for p in self.sam_params]
+        if any(has_grad):
+            torch._foreach_add_(
+                [p.grad for p, flag in zip(self.sam_params, has_grad) if flag],
+                [g for g, flag in zip(self.grad_w, has_grad) if flag]
+            )
+        for p, g, flag in zip(self.sam_params, self.grad_w, has_grad):
+            if not flag:
+                p.grad = g.clone()
+
+    @staticmethod
+    def __to__scalars__(log_dict):
+        """Convert the tensor values of a log dict to python floats with a single device sync"""
+        keys = [key for key, value in log_dict.items() if torch.is_tensor(value)]
+        if not keys:
+            return log_dict
+        values = torch.stack([log_dict[key].float() for key in keys]).tolist()
+        return {**log_dict, **dict(zip(keys, values))}
+
+    def __compute__losses__(
+        self,
+        logits_lb,
+        label_lb,
+        logits_ulb_w,
+        logits_ulb_s,
+        tau_t,
+        p_t,
+        label_hist,
+        logits_ulb_w_hat=None,
+        label_w=None,
+        label_s=None
+    ):
+        """Compute the FreeMatch losses, and the PO loss when the perturbed weak logits are given"""
+        loss_lb = self.ce_criterion(logits_lb, label_lb, reduction='mean')
+        loss_sat, mask, tau_t, p_t, label_hist = self.sat_criterion(
+            logits_ulb_w, logits_ulb_s, tau_t, p_t, label_hist
+        )
+        loss_saf, hist_p_ulb_s = self.saf_criterion(mask, logits_ulb_s, p_t, label_hist) 
+        loss = loss_lb + self.ulb_loss_ratio * loss_sat + self.ent_loss_ratio * loss_saf
+        
+        pseudo_label_g, pseudo_label_s = None, None
+        if logits_ulb_w_hat is None:
+            loss_po = torch.zeros_like(loss_lb)
+        else:
+            pseudo_label_g = torch.softmax(logits_ulb_w_hat, dim=-1)
+            pseudo_label_s = torch.softmax(logits_ulb_s, dim=-1)
+
+            # MSE between the weak and strong oscillations (pseudo label - banked label):
+            # mean(((g - bank_w) - (s - bank_s)) ** 2) == mean(((g - s) - (bank_w - bank_s)) ** 2),
+            # which avoids materializing both oscillation tensors.
+            label_w, label_s = label_w.detach().to(pseudo_label_g.dtype), label_s.detach().to(pseudo_label_s.dtype)
+            delta = (pseudo_label_g - pseudo_label_s) - (label_w - label_s)
+            loss_po = delta.square().mean()
+
+            if self.cfg.TRAINER.POLOSS:
+                loss = loss + loss_po
+        
+        return {
+            'loss': loss,
+            'loss_lb': loss_lb,
+            'loss_sat': loss_sat,
+            'loss_saf': loss_saf,
+            'loss_po': loss_po,
+            'mask': mask,
+            'hist_p_ulb_s': hist_p_ulb_s,
+            'pseudo_label_g': pseudo_label_g,
+            'pseudo_label_s': pseudo_label_s
+        }
         
     def warmup_train(self):
         
@@ -140,20 +263,23 @@ class FreeMatchTrainer:
         start_run = torch.cuda.Event(enable_timing=True)
         end_run = torch.cuda.Event(enable_timing=True)
     
+        train_lb_dl = self.dm.train_lb_dl
+        if self.device == 'cuda':
+            train_lb_dl = CUDAPrefetcher(train_lb_dl, keys=['img_w', 'label'], memory_format=self.memory_format)
+        
         start_batch.record()
         
-        for batch_lb in self.dm.train_lb_dl:
+        for batch_lb in train_lb_dl:
             
             if self.curr_iter >= self.num_warmup_iters:
                 self.curr_iter = 0
                 break
             
             end_batch.record()
-            torch.cuda.synchronize()
             start_run.record()
             
             img_lb_w, label_lb = batch_lb['img_w'], batch_lb['label']
-            img_lb_w, label_lb = img_lb_w.to(self.device), label_lb.to(self.device) 
+            img_lb_w, label_lb = img_lb_w.to(self.device, non_blocking=True, memory_format=self.memory_format), label_lb.to(self.device, non_blocking=True) 
 
             with self.amp():
                 out = self.net(img_lb_w)                
@@ -167,41 +293,45 @@ class FreeMatchTrainer:
             else:
                 loss.backward()
                 self.optim.step()
+            self.model.zero_grad(set_to_none=True)
             
             end_run.record()
-            torch.cuda.synchronize()
-            
-            log_dict = {
-                'warmup/loss': loss.item(),
-                'warmup/lr': self.optim.optimizer.param_groups[0]['lr'],
-                'warmup/fetch_time': start_batch.elapsed_time(end_batch) / 1000,
-                'warmup/run_time': start_run.elapsed_time(end_run) / 1000
-            }
             
             if (self.curr_iter + 1) % self.num_log_iters == 0:
-                pprint.pprint(log_dict, indent=4)
+                # Timing events are only read on logging iterations, sync just there
+                torch.cuda.synchronize()
+                log_dict = {
+                    'warmup/loss': loss.detach(),
+                    'warmup/lr': self.optim.optimizer.param_groups[0]['lr'],
+                    'warmup/fetch_time': start_batch.elapsed_time(end_batch) / 1000,
+                    'warmup/run_time': start_run.elapsed_time(end_run) / 1000
+                }
+                pprint.pprint(self.__to__scalars__(log_dict), indent=4)
+                del log_dict
             
             self.curr_iter += 1
-            del log_dict
             start_batch.record()
     
-            self.model.eval()
-            probs = list()
-            with torch.no_grad():
-                for _, batch in enumerate(self.dm.test_dl):
-                    img_lb_w, label = batch['img_w'], batch['label']
-                    img_lb_w, label = img_lb_w.to(self.device), label.to(self.device)
-                    out = self.model(img_lb_w)
-                    logits = out['logits']
-                    probs.append(logits.softmax(dim=-1))
-                    
-            probs = torch.cat(probs)
-            max_probs, max_idx = torch.max(probs, dim=-1)
+        # Initialize the SAT/SAF statistics from the warmed up model, once after the warmup
+        self.model.eval()
+        num_test = len(self.dm.test_dl.dataset)
+        probs = torch.empty(num_test, self.num_classes, device=self.device)
+        offset = 0
+        with torch.no_grad(), self.amp():
+            for _, batch in enumerate(self.dm.test_dl):
+                img_lb_w = batch['img_w'].to(self.device, non_blocking=True, memory_format=self.memory_format)
+                out = self.model(img_lb_w)
+                logits = out['logits']
+                probs[offset:offset + logits.shape[0]].copy_(logits.softmax(dim=-1))
+                offset += logits.shape[0]
+                
+        max_probs, max_idx = torch.max(probs, dim=-1)
 
-            self.tau_t = max_probs.mean()
-            self.p_t = torch.mean(probs, dim=0)
-            label_hist = torch.bincount(max_idx, minlength=probs.shape[1]).to(probs.dtype) 
-            self.label_hist = label_hist / label_hist.sum()
+        self.state.tau_t.copy_(max_probs.mean())
+        self.state.p_t.copy_(torch.mean(probs, dim=0))
+        # The histogram sums to the number of samples, normalize by it in place
+        self.state.label_hist.copy_(torch.bincount(max_idx, minlength=self.num_classes).to(probs.dtype).div_(max_idx.numel()))
+        self.model.train()
 
     def train(self):
     
@@ -217,24 +347,31 @@ class FreeMatchTrainer:
 
         start_batch.record()
 
-        num_samples = len(self.dm.train_ulb_dl.dataset)  # 示例数目
-        pseudo_label_dim = self.num_classes  # 伪标签的维度
-        label_bank_w = torch.ones(num_samples, pseudo_label_dim, device='cuda') / pseudo_label_dim
-        label_bank_s = torch.ones(num_samples, pseudo_label_dim, device='cuda') / pseudo_label_dim
-        for (batch_lb, batch_ulb) in zip(self.dm.train_lb_dl, self.dm.train_ulb_dl):
+        # Copy the next labeled and unlabeled batches to the GPU while the current step runs
+        if self.device == 'cuda':
+            train_dl = CUDAPrefetcher(
+                self.dm.train_lb_dl,
+                self.dm.train_ulb_dl,
+                keys=[['img_w', 'label'], ['img_w', 'img_s', 'idx']],
+                memory_format=self.memory_format
+            )
+        else:
+            train_dl = zip(self.dm.train_lb_dl, self.dm.train_ulb_dl)
+        
+        for (batch_lb, batch_ulb) in train_dl:
             
             if self.curr_iter >= self.num_train_iters:
                 break
 
             end_batch.record()
-            torch.cuda.synchronize()
             start_run.record()
             
             img_lb_w, label_lb = batch_lb['img_w'], batch_lb['label']
             img_ulb_w, img_ulb_s, idx = batch_ulb['img_w'], batch_ulb['img_s'], batch_ulb['idx']
             
-            img_lb_w, label_lb = img_lb_w.to(self.device), label_lb.to(self.device) 
-            img_ulb_w, img_ulb_s = img_ulb_w.to(self.device), img_ulb_s.to(self.device)
+            img_lb_w, label_lb = img_lb_w.to(self.device, non_blocking=True, memory_format=self.memory_format), label_lb.to(self.device, non_blocking=True) 
+            img_ulb_w, img_ulb_s = img_ulb_w.to(self.device, non_blocking=True, memory_format=self.memory_format), img_ulb_s.to(self.device, non_blocking=True, memory_format=self.memory_format)
+            idx = idx.to(self.device, non_blocking=True)
             
             num_lb = img_lb_w.shape[0]
             num_ulb = img_ulb_w.shape[0]
@@ -244,118 +381,129 @@ class FreeMatchTrainer:
             img = torch.cat([img_lb_w, img_ulb_w, img_ulb_s])
             with self.amp():
                 if self.x_sharp:
-                    enable_running_stats(self.net.model)
-                out = self.net(img)    
-                logits = out['logits']
-                logits_lb = logits[:num_lb]
-                logits_ulb_w, logits_ulb_s = logits[num_lb:].chunk(2)
+                    enable_running_stats(self.bn_modules)
+                    
+                    # The first SAM step only uses the labeled logits (for the perturbation) and the
+                    # weak unlabeled logits (for the pseudo labels). Skipping the strong view saves compute,
+                    # but changes the BN batch statistics of this pass, so it is opt-in.
+                    if self.cfg.TRAINER.SAM_SKIP_STRONG:
+                        out = self.net(img[:num_lb + num_ulb])
+                        logits = out['logits']
+                        logits_lb, logits_ulb_w = logits[:num_lb], logits[num_lb:]
+                    else:
+                        out = self.net(img)
+                        logits = out['logits']
+                        logits_lb = logits[:num_lb]
+                        logits_ulb_w, _ = logits[num_lb:].chunk(2)
+                else:
+                    if self.use_cuda_graph:
+                        if self.graphed_model is None:
+                            print('Capturing the model in CUDA graphs...')
+                            self.graphed_model = make_graphed_model(self.model, img.detach().clone())
+                        logits = self.graphed_model(img)
+                    else:
+                        out = self.net(img)    
+                        logits = out['logits']
+                    logits_lb = logits[:num_lb]
+                    logits_ulb_w, logits_ulb_s = logits[num_lb:].chunk(2)
 
-                loss_lb = self.ce_criterion(logits_lb, label_lb, reduction='mean')
-                
                 if not self.x_sharp:
-                    loss_sat, mask, self.tau_t, self.p_t, self.label_hist = self.sat_criterion(
-                        logits_ulb_w, logits_ulb_s, self.tau_t, self.p_t, self.label_hist
+                    losses = self.compute_losses(
+                        logits_lb, label_lb, logits_ulb_w, logits_ulb_s, self.state.tau_t, self.state.p_t, self.state.label_hist
                     )
 
-                    loss_saf, hist_p_ulb_s = self.saf_criterion(mask, logits_ulb_s, self.p_t, self.label_hist) 
-                    loss = loss_lb + self.ulb_loss_ratio * loss_sat + self.ent_loss_ratio * loss_saf
-
                 else:
+                    loss_lb = self.ce_criterion(logits_lb, label_lb, reduction='mean')
                     with torch.no_grad():
-                        self.grad_w = torch.autograd.grad(loss_lb, self.net.model.parameters(), allow_unused=True)
+                        grad_w = torch.autograd.grad(loss_lb, self.model_params, allow_unused=True)
+                        
+                        # Keep only the params which received a gradient, so that the
+                        # multi-tensor (_foreach) kernels below can work on plain lists
+                        if self.sam_params is None:
+                            self.sam_params = [p for p, g in zip(self.model_params, grad_w) if g is not None]
+                        self.grad_w = [g for g in grad_w if g is not None]
                         scale = self.rho / self.norm(self.grad_w)
-                        self.eps = [g * scale if g is not None else None for g in self.grad_w]
+                        if self.foreach_tensor_scalar:
+                            self.eps = torch._foreach_mul(self.grad_w, scale)
+                        else:
+                            self.eps = [g * scale for g in self.grad_w]
 
                         # model perturbation
-                        for p, v in zip(self.net.model.parameters(), self.eps):
-                            if v is not None:
-                                p.add_(v)
+                        torch._foreach_add_(self.sam_params, self.eps)
 
                     # second propagation step
-                    disable_running_stats(self.net.model)
+                    disable_running_stats(self.bn_modules)
 
                     out_hat = self.net(img)
                     logits_hat = out_hat['logits']
                     logits_lb_hat = logits_hat[:num_lb]
                     logits_ulb_w_hat, logits_ulb_s_hat = logits_hat[num_lb:].chunk(2)
 
-                    loss_lb = self.ce_criterion(logits_lb_hat, label_lb, reduction='mean')
-
-                    loss_sat, mask, self.tau_t, self.p_t, self.label_hist = self.sat_criterion(
-                        logits_ulb_w, logits_ulb_s_hat, self.tau_t, self.p_t, self.label_hist)
-
-                    loss_saf, hist_p_ulb_s = self.saf_criterion(mask, logits_ulb_s_hat, self.p_t, self.label_hist) 
                     ## New 
-                    label_w_expanded = label_bank_w[idx]  
-                    label_s_expanded = label_bank_s[idx] 
-                    pseudo_label_g = torch.softmax(logits_ulb_w_hat, dim=-1)
-                    pseudo_label_s = torch.softmax(logits_ulb_s_hat, dim=-1)
-
-                    # po = torch.abs(pseudo_label_g - label_w_expanded.detach())
-                    # po_s = torch.abs(pseudo_label_s - label_s_expanded.detach())
-                    po = (pseudo_label_g - label_w_expanded.detach())
-                    po_s = (pseudo_label_s - label_s_expanded.detach())
-                    # po = nn.functional.normalize(pseudo_label_g - label_w_expanded.detach(), dim=1)
-                    # po_s = nn.functional.normalize(pseudo_label_s - label_s_expanded.detach(), dim=1)
-                    # x = F.normalize(pseudo_label_g - label_w_expanded.detach(), dim=-1, p=2)
-                    # y = F.normalize(pseudo_label_s - label_s_expanded.detach(), dim=-1, p=2)
-
-                    mse_loss_fn = nn.MSELoss()
-                    loss_po = mse_loss_fn(po, po_s)
-                    # loss_po = 2 - 2 * (x * y).sum(dim=-1)
-                    # loss_po = loss_po.mean()
-
-                    if self.cfg.TRAINER.POLOSS:
-                        loss = loss_lb + self.ulb_loss_ratio * loss_sat + self.ent_loss_ratio * loss_saf + loss_po
-                    else:
-                        loss = loss_lb + self.ulb_loss_ratio * loss_sat + self.ent_loss_ratio * loss_saf
+                    label_w_expanded = self.label_bank_w.index_select(0, idx)
+                    label_s_expanded = self.label_bank_s.index_select(0, idx)
+                    
+                    losses = self.compute_losses(
+                        logits_lb_hat, label_lb, logits_ulb_w, logits_ulb_s_hat, self.state.tau_t, self.state.p_t, self.state.label_hist,
+                        logits_ulb_w_hat=logits_ulb_w_hat, label_w=label_w_expanded, label_s=label_s_expanded
+                    )
                  
-                    label_bank_w[idx] = pseudo_label_g.detach()
-                    label_bank_s[idx] = pseudo_label_s.detach()
+                    self.label_bank_w.index_copy_(0, idx, losses['pseudo_label_g'].detach().to(self.label_bank_w.dtype))
+                    self.label_bank_s.index_copy_(0, idx, losses['pseudo_label_s'].detach().to(self.label_bank_s.dtype))
+                
+                loss = losses['loss']
 
             if self.cfg.TRAINER.AMP_ENABLED:
                 self.scaler.scale(loss).backward()
                 if self.x_sharp:
-                    with torch.no_grad():
-                        for p, v, g in zip(self.net.model.parameters(), self.eps, self.grad_w):
-                            if v is not None:
-                                p.sub_(v)
-                                p.grad += g
+                    self.__restore__sam__params__()
                 self.scaler.step(self.optim.optimizer)
                 self.scaler.update()
             else:
                 loss.backward()
                 if self.x_sharp:
-                    with torch.no_grad():
-                        for p, v, g in zip(self.net.model.parameters(), self.eps, self.grad_w):
-                            if v is not None:
-                                p.sub_(v)
-                                p.grad += g
+                    self.__restore__sam__params__()
                 self.optim.step()
             
             self.sched.step()
             self.net.update()
-            self.model.zero_grad()
+            self.model.zero_grad(set_to_none=True)
 
             end_run.record()
-            torch.cuda.synchronize()
             
-            # Logging in tensorboard
-            log_dict = {
-                'train/lb_loss': loss_lb.item(),
-                'train/sat_loss': loss_sat.item(),
-                'train/saf_loss': loss_saf.item(),
-                'train/po_loss': loss_po.item(),
-                'train/total_loss': loss.item(),
-                'train/mask': 1 - mask.mean().item(),
-                'train/tau_t': self.tau_t.item(),
-                'train/p_t': self.p_t.mean().item(),
-                'train/label_hist': self.label_hist.mean().item(),
-                'train/label_hist_s': hist_p_ulb_s.mean().item(),
-                'train/lr': self.optim.optimizer.param_groups[0]['lr']
-            } 
+            log_iter = (self.curr_iter + 1) % self.num_log_iters == 0
+            eval_iter = (self.curr_iter + 1) % self.num_eval_iters == 0
+            
+            # Logging in tensorboard. The values are only gathered on the iterations where
+            # they are actually logged, and synced (.item()) there all at once.
+            if log_iter or eval_iter:
+                log_dict = self.__to__scalars__({
+                    'train/lb_loss': losses['loss_lb'].detach(),
+                    'train/sat_loss': losses['loss_sat'].detach(),
+                    'train/saf_loss': losses['loss_saf'].detach(),
+                    'train/po_loss': losses['loss_po'].detach(),
+                    'train/total_loss': loss.detach(),
+                    'train/mask': 1 - losses['mask'].mean(),
+                    'train/tau_t': self.state.tau_t,
+                    'train/p_t': self.state.p_t.mean(),
+                    'train/label_hist': self.state.label_hist.mean(),
+                    'train/label_hist_s': losses['hist_p_ulb_s'].mean(),
+                    'train/lr': self.optim.optimizer.param_groups[0]['lr']
+                })
             
-            if (self.curr_iter + 1) % self.num_eval_iters == 0:
+            if eval_iter and self.async_eval:
+                
+                # The previous validation is collected before its snapshot gets overwritten
+                self.__finish__validate__()
+                print('Evaluating...')
+                save_dir = osp.join(self.cfg.LOG_DIR, self.cfg.RUN_NAME, self.cfg.OUTPUT_DIR)
+                if not osp.exists(save_dir):
+                    os.makedirs(save_dir)
+                self.__save__model__(save_dir, 'last_checkpoint.pth')
+                self.pending_eval = (self.curr_iter, self.validate_async())
+                self.tb.update(log_dict, self.curr_iter)
+            
+            elif eval_iter:
                 
                 print('Evaluating...')
                 validate_dict = self.validate()
@@ -379,59 +527,157 @@ class FreeMatchTrainer:
                 )
                 self.tb.update(log_dict, self.curr_iter)
                 
-            if (self.curr_iter + 1) % self.num_log_iters == 0:
+            if log_iter:
                 
+                # Timing events are only read on logging iterations, sync just there
+                torch.cuda.synchronize()
                 print('Iteration: %d / %d' % (self.curr_iter + 1, self.num_train_iters))
                 print('Fetch Time: %.3f, Run Time: %.3f' % (start_batch.elapsed_time(end_batch) / 1000, start_run.elapsed_time(end_run) / 1000 ))
                 pprint.pprint(log_dict, indent=4)
 
+            if log_iter or eval_iter:
+                del log_dict
             self.curr_iter += 1
-            del log_dict
             start_batch.record()
+        
+        self.__finish__validate__()
 
-    @torch.no_grad()
     def validate(self):
 
         self.net.eval()
+        results = self.__evaluate__(self.net)
+        self.net.train()
+    
+        return self.__summarize__(results)
+
+    def validate_async(self):
+        """Validate a snapshot of the EMA weights concurrently with training.
+        
+        The test set is loaded and the eval kernels are launched from a background thread on
+        a side stream, so neither blocks the training thread. Returns the started thread and
+        a dict which holds the (device) results once the thread is joined.
+        """
+        if self.eval_model is None:
+            self.eval_model = copy.deepcopy(self.model).eval()
+            self.val_stream = torch.cuda.Stream()
         
-        total_loss, total_num = 0, 0
+        # Snapshot the EMA weights and the BN statistics on the training stream
+        with torch.no_grad():
+            src = [self.net.ema[name] if name in self.net.ema else param for name, param in self.model.named_parameters()]
+            src += list(self.model.buffers())
+            dst = list(self.eval_model.parameters()) + list(self.eval_model.buffers())
+            if hasattr(torch, '_foreach_copy_'):
+                torch._foreach_copy_(dst, src)
+            else:
+                for dst_tensor, src_tensor in zip(dst, src):
+                    dst_tensor.copy_(src_tensor)
+        
+        self.val_stream.wait_stream(torch.cuda.current_stream())
+        results = dict()
+        
+        def _run():
+            # The current stream (and device) is per thread, enter the side stream in the worker
+            with torch.cuda.stream(self.val_stream):
+                results.update(self.__evaluate__(self.eval_model))
+            self.val_stream.synchronize()
+        
+        thread = threading.Thread(target=_run, daemon=True)
+        thread.start()
+        return thread, results
+
+    @torch.no_grad()
+    def __evaluate__(self, net):
+        
+        # Everything is accumulated on the device, the only sync is when reading the results.
+        total_loss, total_num = torch.zeros((), device=self.device), 0
         labels, preds = list(), list()
         for _, batch in enumerate(self.dm.test_dl):
             
             img_lb_w, label = batch['img_w'], batch['label']
-            img_lb_w, label = img_lb_w.to(self.device), label.to(self.device)
-            out = self.net(img_lb_w)
+            img_lb_w, label = img_lb_w.to(self.device, non_blocking=True, memory_format=self.memory_format), label.to(self.device, non_blocking=True)
+            out = net(img_lb_w)
             
             logits = out['logits']
             loss = self.ce_criterion(logits, label, reduction='mean')
-            labels.extend(label.cpu().tolist())
-            preds.extend(torch.max(logits, dim=-1)[1].cpu().tolist())
+            labels.append(label)
+            preds.append(torch.max(logits, dim=-1)[1])
             total_num += img_lb_w.shape[0]
-            total_loss += loss.detach().item() * img_lb_w.shape[0]
-           
-        acc = accuracy_score(labels, preds)
-        precision = precision_score(labels, preds, average='macro')
-        recall = recall_score(labels, preds, average='macro')
-        f1 = f1_score(labels, preds, average='macro')       
-        cf = confusion_matrix(labels, preds)
-        cr = classification_report(labels, preds)
+            total_loss += loss.detach() * img_lb_w.shape[0]
+        
+        return {
+            'loss': total_loss / total_num,
+            'labels': torch.cat(labels),
+            'preds': torch.cat(preds)
+        }
+
+    @torch.no_grad()
+    def __summarize__(self, results):
+        
+        # sklearn (and scipy) are slow to import, only load them when a report is printed
+        from sklearn.metrics import classification_report
+        
+        labels, preds = results['labels'], results['preds']
+        cf = torch.zeros(self.num_classes, self.num_classes, dtype=torch.long, device=self.device)
+        cf.index_put_((labels, preds), torch.ones_like(labels), accumulate=True)
+        
+        # Macro averages over the classes present in the labels or the predictions, same as sklearn
+        tp = cf.diag().float()
+        support, predicted = cf.sum(dim=1).float(), cf.sum(dim=0).float()
+        present = ((support + predicted) > 0).float()
+        precision = (tp / predicted.clamp(min=1) * present).sum() / present.sum()
+        recall = (tp / support.clamp(min=1) * present).sum() / present.sum()
+        f1 = (2 * tp / (support + predicted).clamp(min=1) * present).sum() / present.sum()
+        acc = tp.sum() / labels.shape[0]
+        
+        loss, acc, precision, recall, f1 = torch.stack([results['loss'], acc, precision, recall, f1]).tolist()
+        cr = classification_report(labels.cpu().numpy(), preds.cpu().numpy())
 
         print('Classification Report: \n')
         print(cr)
         
         print('Confusion Matrix \n')
-        print(np.array_str(cf))
+        print(np.array_str(cf.cpu().numpy()))
 
-        self.net.train()
-    
         return {
-            'validation/loss': total_loss / total_num,
+            'validation/loss': loss,
             'validation/accuracy': acc,
             'validation/precision': precision,
             'validation/recall': recall,
             'validation/f1': f1
         }
 
+    def __finish__validate__(self):
+        
+        # Collect the pending asynchronous validation, if any
+        if self.pending_eval is None:
+            return
+        
+        eval_iter, (thread, results) = self.pending_eval
+        self.pending_eval = None
+        thread.join()
+        validate_dict = self.__summarize__(results)
+        
+        # last_checkpoint.pth was saved when the validation was launched, i.e. with the validated weights
+        save_dir = osp.join(self.cfg.LOG_DIR, self.cfg.RUN_NAME, self.cfg.OUTPUT_DIR)
+        if validate_dict['validation/accuracy'] > self.best_test_acc:
+            self.best_test_acc = validate_dict['validation/accuracy']
+            self.best_test_iter = eval_iter
+            ckpt = torch.load(osp.join(save_dir, 'last_checkpoint.pth'), map_location='cpu')
+            ckpt.update({'best_test_iter': self.best_test_iter, 'best_test_acc': self.best_test_acc})
+            for save_name in ['best_checkpoint.pth', 'last_checkpoint.pth']:
+                torch.save(ckpt, osp.join(save_dir, save_name))
+            print('Model saved sucessfully. Path: %s' % osp.join(save_dir, 'best_checkpoint.pth'))
+        
+        validate_dict.update(
+                    {
+                        'best_acc': self.best_test_acc,
+                        'best_iter': self.best_test_iter
+                    }
+        )
+        print('Validation at iteration: %d' % (eval_iter + 1))
+        pprint.pprint(validate_dict, indent=4)
+        self.tb.update(validate_dict, eval_iter)
+
     def __save__model__(self, save_dir, save_name='latest.ckpt'):
 
         save_dict = {
@@ -442,9 +688,9 @@ class FreeMatchTrainer:
             'curr_iter': self.curr_iter,
             'best_test_iter': self.best_test_iter,
             'best_test_acc': self.best_test_acc,
-            'tau_t': self.tau_t.cpu(),
-            'p_t': self.p_t.cpu(),
-            'label_hist': self.label_hist.cpu()
+            'tau_t': self.state.tau_t.cpu(),
+            'p_t': self.state.p_t.cpu(),
+            'label_hist': self.state.label_hist.cpu()
         }
 
         torch.save(save_dict, osp.join(save_dir, save_name))
@@ -461,9 +707,9 @@ class FreeMatchTrainer:
 
         # Algorithm specfic loading
         self.curr_iter = ckpt['curr_iter']
-        self.tau_t = ckpt['tau_t']
-        self.p_t = ckpt['p_t']
-        self.label_hist = ckpt['label_hist']
+        self.state.tau_t.copy_(ckpt['tau_t'])
+        self.state.p_t.copy_(ckpt['p_t'])
+        self.state.label_hist.copy_(ckpt['label_hist'])
         self.best_test_iter = ckpt['best_test_iter']
         self.best_test_acc = ckpt['best_test_acc']
         
@@ -471,9 +717,3 @@ class FreeMatchTrainer:
         print('Initialized checkpoint parameters..')
         print(f'Best Accuracy: {self.best_test_acc} Best Iteration: {self.best_test_iter}')
         print('Model loaded from checkpoint. Path: %s' % load_path)
-
-    def __toggle__device__(self):
-        
-        self.p_t = self.p_t.to(self.device)
-        self.tau_t = self.tau_t.to(self.device)
-        self.label_hist = self.label_hist.to(self.device)
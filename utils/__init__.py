@@ -3,4 +3,5 @@ from .optimizer import FreeMatchOptimizer
 from .scheduler import FreeMatchScheduler
 from .ema import EMA
 from .losses import ConsistencyLoss, SelfAdaptiveFairnessLoss, SelfAdaptiveThresholdLoss, CELoss
-from .bypass_bn import disable_running_stats, enable_running_stats
\ No newline at end of file
+from .bypass_bn import disable_running_stats, enable_running_stats, get_bn_modules
+from .cuda_graph import make_graphed_model
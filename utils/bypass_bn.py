@@ -2,17 +2,15 @@ import torch
 import torch.nn as nn
 from torch.nn.modules.batchnorm import _BatchNorm
 
-def disable_running_stats(model):
-    def _disable(module):
-        if isinstance(module, _BatchNorm):
-            module.backup_momentum = module.momentum
-            module.momentum = 0
+def get_bn_modules(model):
+    return [module for module in model.modules() if isinstance(module, _BatchNorm)]
 
-    model.apply(_disable)
+def disable_running_stats(bn_modules):
+    for module in bn_modules:
+        module.backup_momentum = module.momentum
+        module.momentum = 0
 
-def enable_running_stats(model):
-    def _enable(module):
-        if isinstance(module, _BatchNorm) and hasattr(module, "backup_momentum"):
+def enable_running_stats(bn_modules):
+    for module in bn_modules:
+        if hasattr(module, "backup_momentum"):
             module.momentum = module.backup_momentum
-
-    model.apply(_enable)
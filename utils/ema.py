@@ -17,9 +17,10 @@ class EMA:
     
     def load_state_dict(self, state):
         
+        # Copy in place to keep the device and memory format of the registered weights
         for key, value in state.items():
             assert key in self.ema.keys()
-            self.ema[key] = value
+            self.ema[key].copy_(value)
         
     def train(self):
         
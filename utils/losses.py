@@ -76,12 +76,14 @@ class SelfAdaptiveThresholdLoss:
         # Updating the histogram for the SAF loss here so that I dont have to call the torch.no_grad() function again. 
         # You can do it in the SAF loss also, but without accumulating the gradient through the weak augmented logits
         
+        # The params are updated in place, so that the caller's tensors (e.g. registered buffers)
+        # keep the same storage from one step to the next.
         probs_ulb_w = torch.softmax(logits_ulb_w, dim=-1)
         max_probs_w, max_idx_w = torch.max(probs_ulb_w, dim=-1)
-        tau_t = tau_t * self.sat_ema + (1. - self.sat_ema) * max_probs_w.mean()
-        p_t = p_t * self.sat_ema + (1. - self.sat_ema) * probs_ulb_w.mean(dim=0)
-        histogram = torch.bincount(max_idx_w, minlength=p_t.shape[0]).to(p_t.dtype)
-        label_hist = label_hist * self.sat_ema + (1. - self.sat_ema) * (histogram / histogram.sum())
+        tau_t.mul_(self.sat_ema).add_(max_probs_w.mean(), alpha=1. - self.sat_ema)
+        p_t.mul_(self.sat_ema).add_(probs_ulb_w.mean(dim=0), alpha=1. - self.sat_ema)
+        histogram = torch.bincount(max_idx_w, minlength=p_t.shape[0]).to(p_t.dtype).div_(max_idx_w.numel())
+        label_hist.mul_(self.sat_ema).add_(histogram, alpha=1. - self.sat_ema)
         return tau_t, p_t, label_hist
    
     def __call__(self, logits_ulb_w, logits_ulb_s, tau_t, p_t, label_hist):
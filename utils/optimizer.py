@@ -27,7 +27,7 @@ class FreeMatchOptimizer:
         self.optimizer.step()
     
     def zero_grad(self):
-        self.optimizer.zero_grad()
+        self.optimizer.zero_grad(set_to_none=True)
 
     def __repr__(self):
 